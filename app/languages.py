@@ -41,17 +41,18 @@ LANGUAGES = [
     {"code": "vi", "name": "Vietnamese"}
 ]
 
+# Lookup tables built once at import time
+_CODE_SET = frozenset(lang["code"] for lang in LANGUAGES)
+_CODE_TO_NAME = {lang["code"]: lang["name"] for lang in LANGUAGES}
+
 def get_languages() -> List[Dict[str, str]]:
     """Get list of supported languages"""
     return LANGUAGES
 
 def is_language_supported(code: str) -> bool:
     """Check if language code is supported"""
-    return any(lang["code"] == code for lang in LANGUAGES)
+    return code in _CODE_SET
 
 def get_language_name(code: str) -> str:
     """Get language name from code"""
-    for lang in LANGUAGES:
-        if lang["code"] == code:
-            return lang["name"]
-    return code
+    return _CODE_TO_NAME.get(code, code)
@@ -1,43 +1,69 @@
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import RedirectResponse, JSONResponse, Response
+from fastapi.responses import RedirectResponse, Response, FileResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 import base64
-import json
+import logging
 import os
+import re
+import time
 import asyncio
+import functools
+import math
+from contextlib import asynccontextmanager
+import hashlib
+import orjson
 from pathlib import Path
-from typing import Optional, Dict
-from pydantic import BaseModel
-from urllib.parse import unquote, quote
-from .subtitles import SubtitleProcessor
+from typing import Optional, Dict, Tuple, Callable, Awaitable
+from pydantic import BaseModel, ConfigDict
+from urllib.parse import quote, parse_qsl
+from .subtitles import SubtitleProcessor, RateLimitedError, CACHE_DIR, content_etag
 from .translation import TranslationManager
 from .languages import get_languages, is_language_supported, get_language_name
 
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Release shared HTTP connections on shutdown"""
+    yield
+    await SubtitleProcessor.close_session()
+
 # Initialize FastAPI
-app = FastAPI(debug=True)
+app = FastAPI(debug=False, lifespan=lifespan)
+
+_ASSET_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+class CachedStaticFiles(StaticFiles):
+    """Static files that let clients cache logo and wallpaper assets indefinitely"""
+
+    def file_response(self, *args, **kwargs) -> Response:
+        response = super().file_response(*args, **kwargs)
+        if response.status_code == 200:
+            response.headers["Cache-Control"] = _ASSET_CACHE_CONTROL
+        return response
 
 # Mount static files and loading subtitle
-app.mount("/assets", StaticFiles(directory=Path(__file__).parent / "assets"), name="assets")
+app.mount("/assets", CachedStaticFiles(directory=Path(__file__).parent / "assets", check_dir=False), name="assets")
+
+# Loading subtitle never changes at runtime, read it once
+_LOADING_SRT_BYTES = (Path(__file__).parent / "assets" / "loading.srt").read_bytes()
+_LOADING_HEADERS = {"Content-Disposition": "attachment; filename=loading.srt"}
 
 @app.get("/loading.srt")
 async def loading_subtitle():
     """Serve the loading subtitle file"""
-    loading_path = Path(__file__).parent / "assets" / "loading.srt"
-    with open(loading_path, "r", encoding="utf-8") as f:
-        return Response(
-            content=f.read(),
-            media_type="application/x-subrip",
-            headers={"Content-Disposition": "attachment; filename=loading.srt"}
-        )
+    return Response(
+        content=_LOADING_SRT_BYTES,
+        media_type="application/x-subrip",
+        headers=_LOADING_HEADERS
+    )
 
 # Initialize templates
 templates = Jinja2Templates(directory="templates")
 
-# Ensure cache directories exist
-CACHE_DIR = Path("subtitles")
-CACHE_DIR.mkdir(exist_ok=True)
-
+@functools.lru_cache(maxsize=1)
 def get_base_url():
     """Get base URL from environment or default"""
     domain = os.getenv("BASE_DOMAIN", "localhost:7000")
@@ -45,8 +71,8 @@ def get_base_url():
     return f"{protocol}://{domain}"
 
 # Manifest definition
+@functools.lru_cache(maxsize=4)
 def get_manifest(base_url: str):
-    domain = base_url.replace("https://", "").replace("http://", "")
     manifest = {
         "id": "org.stremio.aitranslator",
         "version": "1.6.3",
@@ -62,34 +88,109 @@ def get_manifest(base_url: str):
     }
     return manifest
 
+@functools.lru_cache(maxsize=4)
+def _manifest_response(base_url: str) -> Tuple[bytes, str]:
+    """Serialized manifest and its ETag, encoded once per base URL"""
+    content = orjson.dumps(get_manifest(base_url))
+    return content, content_etag(content)
+
+def _json_response(data: Dict) -> Response:
+    """Serialize with orjson straight into a plain Response"""
+    return Response(content=orjson.dumps(data), media_type="application/json")
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header (list, weak or '*' forms) covers this ETag"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+def _json_or_not_modified(request: Request, content: bytes, etag: str) -> Response:
+    """Return 304 when the client already holds this body, else the JSON bytes with their ETag"""
+    headers = {"ETag": etag}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=content, media_type="application/json", headers=headers)
+
 class Config(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     key: Optional[str] = None  # Gemini API key
     lang: Optional[str] = None
     opensubtitles_key: Optional[str] = None  # OpenSubtitles API key
     opensubtitles_app: Optional[str] = None  # OpenSubtitles app name
 
-async def get_config(config_b64: Optional[str] = None) -> Config:
+@functools.lru_cache(maxsize=1024)
+def _decode_config(config_b64: str) -> Config:
+    """Decode and validate base64 config, memoized per config string"""
+    # Pad to a multiple of 4 without branching
+    config_json = base64.urlsafe_b64decode(config_b64 + "==="[:-len(config_b64) % 4]).decode()
+    config = Config.model_validate_json(config_json)
+    if not is_language_supported(config.lang):
+        raise ValueError(f"Unsupported language: {config.lang}")
+    return config
+
+def get_config(config_b64: Optional[str] = None) -> Config:
     """Get configuration from base64 or default values"""
     if config_b64:
         try:
-            # Add padding if needed
-            padding = 4 - (len(config_b64) % 4)
-            if padding != 4:
-                config_b64 += '=' * padding
-            
-            config_json = base64.urlsafe_b64decode(config_b64).decode()
-            config = Config.parse_raw(config_json)
-            if not is_language_supported(config.lang):
-                raise ValueError(f"Unsupported language: {config.lang}")
-            return config
+            return _decode_config(config_b64)
         except Exception as e:
-            print(f"Config error: {e}")
+            logger.warning("Config error: %s", e)
     return Config()
 
+# Filename markers suggesting the stream carries its own subtitles
+_EMBEDDED_SUBS_RE = re.compile(r"\.srt|sub|dubbed|multi")
+
+def raw_path_segment(request: Request, fallback: str) -> str:
+    """Last path segment as sent by the client, before Starlette percent-decodes it"""
+    raw_path = request.scope.get("raw_path")
+    if not raw_path:
+        return fallback
+    return raw_path.decode("latin-1").rsplit("/", 1)[-1]
+
+def parse_stream_info(video_hash: str) -> Dict[str, str]:
+    """Extract stream metadata from Stremio's videoHash=123&videoSize=456&filename=show.mp4 format"""
+    if '=' not in video_hash:
+        return {}
+    params = dict(parse_qsl(video_hash, keep_blank_values=True))
+    return {
+        'filename': params.get('filename', ''),
+        'videoHash': params.get('videoHash', ''),
+        'videoSize': params.get('videoSize', '')
+    }
+
+def build_embedded_entry(stream_info: Dict[str, str]) -> Optional[Dict]:
+    """Subtitle entry for streams whose filename suggests embedded English subtitles"""
+    filename = stream_info.get('filename', '').lower()
+    if not filename or not _EMBEDDED_SUBS_RE.search(filename):
+        return None
+    return {
+        "id": "eng-embedded",  # Unique identifier
+        "lang": "eng",         # ISO 639-2 code
+        "url": None            # Null URL for embedded subtitles
+    }
+
+# Subtitle lookups in progress, shared by concurrent requests for the same key
+_inflight: Dict[str, asyncio.Task] = {}
+
+async def _single_flight(key: str, factory: Callable[[], Awaitable[Tuple[bytes, str]]]) -> Tuple[bytes, str]:
+    """Run factory once per key, concurrent callers await the same task"""
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(factory())
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # Shield so one disconnecting client does not cancel the shared work
+    return await asyncio.shield(task)
+
+_HEALTH_BYTES = b'{"status":"ok"}'
+
 @app.get("/health")
 async def health():
     """Health check endpoint"""
-    return {"status": "ok"}
+    return Response(content=_HEALTH_BYTES, media_type="application/json")
 
 @app.get("/")
 async def root():
@@ -115,7 +216,7 @@ async def configure(request: Request):
 @app.get("/{config_b64}/configure")
 async def configure_with_config(request: Request, config_b64: str):
     """Configuration page with existing config"""
-    config = await get_config(config_b64)
+    config = get_config(config_b64)
     base_url = get_base_url()
     manifest = get_manifest(base_url)
     return templates.TemplateResponse(
@@ -134,12 +235,12 @@ async def configure_with_config(request: Request, config_b64: str):
 async def manifest(request: Request, config_b64: Optional[str] = None):
     """Manifest endpoint"""
     base_url = get_base_url()
-    manifest_data = get_manifest(base_url)
-    return JSONResponse(manifest_data)
+    return _json_or_not_modified(request, *_manifest_response(base_url))
 
 @app.get("/{config_b64}/subtitles/{type}/{id}/{video_hash}.json")
 @app.get("/{config_b64}/subtitles/{cache_key}/translated.srt")
 async def subtitles(
+    request: Request,
     config_b64: str,
     type: str = None,
     id: str = None,
@@ -148,87 +249,66 @@ async def subtitles(
 ):
     """Subtitle endpoint with smart caching and reuse"""
     try:
-        config = await get_config(config_b64)
+        config = get_config(config_b64)
+        base_url = get_base_url()
         
         # Handle translated.srt request
         if cache_key:
             # Convert URL-encoded cache key back to filesystem-safe format
             fs_cache_key = cache_key.replace('%3A', ':')
             srt_path = CACHE_DIR / f"{fs_cache_key}.srt"
-            if not srt_path.exists():
+            try:
+                stat_result = await asyncio.to_thread(os.stat, srt_path)
+            except FileNotFoundError:
+                raise HTTPException(status_code=404, detail="Subtitle not found")
+            # Expired files are about to be pruned, treat them as gone
+            if time.time() - stat_result.st_mtime > SubtitleProcessor.cache_ttl:
                 raise HTTPException(status_code=404, detail="Subtitle not found")
-            return Response(
-                content=srt_path.read_text(),
+            # Pass the stat along so FileResponse does not stat again at send time
+            return FileResponse(
+                srt_path,
+                stat_result=stat_result,
                 media_type="application/x-subrip",
-                headers={"Content-Disposition": f"attachment; filename={fs_cache_key}.srt"}
+                filename=f"{fs_cache_key}.srt"
             )
 
         # Handle subtitle list request
-        video_hash = unquote(video_hash).split('.json')[0]  # Remove .json and decode
-        if '=' in video_hash:
-            # Handle Stremio's hash format: videoHash=123&videoSize=456&filename=show.mp4
-            params = dict(param.split('=') for param in video_hash.split('&'))
-            video_hash = params.get('videoHash', '')
-            video_filename = params.get('filename', '')
-            if video_filename:
-                # Pass filename in the id for subtitle matching
-                id = f"{id}&filename={video_filename}"
+        # Stremio percent-encodes each value, parse_qsl decodes them exactly once
+        video_hash = raw_path_segment(request, video_hash).removesuffix('.json')
+        
+        stream_info = parse_stream_info(video_hash)
+        if stream_info:
+            video_hash = stream_info['videoHash']
+            if stream_info['filename']:
+                # Pass filename in the id for subtitle matching, quoted so '&' or '=' survive parse_qsl
+                id = f"{id}&filename={quote(stream_info['filename'])}"
         
         if not config.key:
             raise HTTPException(status_code=400, detail="API key not configured")
         
         if not config.lang:
             raise HTTPException(status_code=400, detail="Target language not configured")
-            
-        # Initialize response subtitles list
-        response_subtitles = []
-        
-        # Extract stream metadata
-        stream_info = {}
-        if '=' in video_hash:
-            params = dict(param.split('=') for p in video_hash.split('&'))
-            stream_info = {
-                'filename': params.get('filename', ''),
-                'videoHash': params.get('videoHash', ''),
-                'videoSize': params.get('videoSize', '')
-            }
-            
-            if stream_info['filename']:
-                print(f"Stream metadata:")
-                print(f"- Filename: {stream_info['filename']}")
-                print(f"- Video hash: {stream_info['videoHash']}")
-                print(f"- Video size: {stream_info['videoSize']}")
-
-        # Check for embedded subtitles
-        print("Checking for English subtitles in stream...")
-        print(f"Stream metadata: {json.dumps(stream_info, indent=2)}")
         
-        # Check if stream has embedded subtitles
-        has_embedded = False
         if stream_info.get('filename'):
-            # Look for common subtitle indicators in filename
-            filename = stream_info['filename'].lower()
-            has_embedded = any(x in filename for x in ['.srt', 'sub', 'dubbed', 'multi'])
-            print(f"Checking filename '{filename}' for subtitle indicators: {has_embedded}")
-            
-            if has_embedded:
-                print("Stream has embedded English subtitles, adding as primary option")
-                response_subtitles.append({
-                    "id": "eng-embedded",  # Unique identifier
-                    "lang": "eng",         # ISO 639-2 code
-                    "url": None            # Null URL for embedded subtitles
-                })
+            logger.debug("Stream metadata:")
+            logger.debug("- Filename: %s", stream_info['filename'])
+            logger.debug("- Video hash: %s", stream_info['videoHash'])
+            logger.debug("- Video size: %s", stream_info['videoSize'])
+
+        # Check if stream has embedded subtitles
+        embedded_entry = build_embedded_entry(stream_info)
+        logger.debug("Embedded English subtitles detected: %s", embedded_entry is not None)
 
         if not config.opensubtitles_key:
-            print("No OpenSubtitles API key configured")
-            if not response_subtitles:
-                print("No embedded subtitles found, showing loading message")
-                response_subtitles.append({
-                    "id": "loading",
-                    "lang": config.lang,  # Keep language code for loading message
-                    "url": f"{get_base_url()}/loading.srt"
-                })
-            return JSONResponse({"subtitles": response_subtitles})
+            logger.debug("No OpenSubtitles API key configured")
+            if embedded_entry:
+                return _json_response({"subtitles": [embedded_entry]})
+            logger.debug("No embedded subtitles found, showing loading message")
+            return _json_response({"subtitles": [{
+                "id": "loading",
+                "lang": config.lang,  # Keep language code for loading message
+                "url": f"{base_url}/loading.srt"
+            }]})
         
         # Initialize processors
         subtitle_processor = SubtitleProcessor(
@@ -239,65 +319,66 @@ async def subtitles(
         
         # Create cache key that includes user-specific data
         base_id = id.split('&')[0]  # Remove filename from ID
-        fs_cache_key = f"{config_b64}-{type}-{base_id}"  # Include config in cache key
+        title_key = f"{config_b64}-{type}-{base_id}"  # Include config in cache key
+        # The chosen release (cue timings, embedded entry) depends on the filename
+        filename = stream_info.get('filename')
+        fs_cache_key = f"{title_key}-{hashlib.sha1(filename.encode()).hexdigest()[:16]}" if filename else title_key
         url_cache_key = quote(fs_cache_key)  # URL-encoded format
         
         cache_path = CACHE_DIR / f"{fs_cache_key}.json"
         cached = await subtitle_processor.load_cache(cache_path)
         if cached:
-            return JSONResponse(cached)
-        
-        # Parse video ID
-        imdb_id, season, episode = None, None, None
-        if type == 'series' and ':' in id:
-            parts = id.split(':')
-            imdb_id = parts[0]
-            if len(parts) > 2:
-                season = parts[1]
-                episode = parts[2]
-        else:
-            imdb_id = id
+            return _json_or_not_modified(request, *cached)
         
-        # Fetch subtitles
-        entries = await subtitle_processor.fetch_subtitles(type, imdb_id, season, episode)
+        async def build_response() -> Tuple[bytes, str]:
+            # Fetch subtitles, the id carries the filename for release matching
+            entries = await subtitle_processor.fetch_subtitles(type, id)
         
-        # Define subtitles handler
-        subtitles = []
+            subtitles = [embedded_entry] if embedded_entry else []
 
-        # Check for embedded subtitles
-        if stream_info.get('filename'):
-            filename = stream_info['filename'].lower()
-            has_embedded = any(x in filename for x in ['.srt', 'sub', 'dubbed', 'multi'])
-            if has_embedded:
+            # Fetch subtitles from OpenSubtitles
+            lang = config.lang
+            url_prefix = f"{base_url}/{config_b64}/subtitles/{url_cache_key}/translated.srt#"
+            for entry in entries:
+                start = str(entry.start)
                 subtitles.append({
-                    "id": "eng-embedded",
-                    "lang": "eng",
-                    "url": None
+                    "id": f"{start}-{lang}",
+                    "lang": lang,
+                    "url": url_prefix + start
                 })
 
-        # Fetch subtitles from OpenSubtitles
-        if config.opensubtitles_key:
-            for entry in entries:
-                subtitles.append({
-                    "id": f"{entry.start}-{config.lang}",
+            # Loading message if no subtitles found, not cached so the title is retried next time
+            if not subtitles:
+                content = orjson.dumps({"subtitles": [{
+                    "id": "loading",
                     "lang": config.lang,
-                    "url": f"{get_base_url()}/{config_b64}/subtitles/{url_cache_key}/translated.srt#{entry.start}"
-                })
+                    "url": f"{base_url}/loading.srt"
+                }]})
+                return content, content_etag(content)
 
-        # Add loading message if no subtitles found
-        if not subtitles:
-            subtitles.append({
-                "id": "loading",
-                "lang": config.lang,
-                "url": f"{get_base_url()}/loading.srt"
-            })
+            return await subtitle_processor.save_cache(cache_path, {"subtitles": subtitles})
 
-        return JSONResponse({"subtitles": subtitles})
+        # Same release-aware key as the cache, so different releases are never merged
+        content, etag = await _single_flight(fs_cache_key, build_response)
+        return _json_or_not_modified(request, content, etag)
         
+    except HTTPException:
+        raise
+    except RateLimitedError as e:
+        logger.warning("Subtitle error: %s", e)
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
     except Exception as e:
-        print(f"Subtitle error: {str(e)}")  # Log the error
+        logger.error("Subtitle error: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=7000)
+    # In-memory caches are per worker process
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=7000,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    )
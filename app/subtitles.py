@@ -1,142 +1,389 @@
-import json
-from typing import List, Dict, Optional, Tuple
+import logging
+import orjson
+from typing import List, Dict, Optional, Tuple, AsyncIterator, FrozenSet
 from pathlib import Path
 import asyncio
+import codecs
+import hashlib
+import os
+import tempfile
 import aiohttp
-from datetime import datetime, timedelta
-from difflib import SequenceMatcher
+import time
 import re
+from collections import OrderedDict
+from operator import itemgetter
+from urllib.parse import parse_qsl
+
+logger = logging.getLogger(__name__)
+
+# Ensure cache directories exist, shared by response, translated SRT and download caches
+CACHE_DIR = Path("subtitles")
+CACHE_DIR.mkdir(exist_ok=True)
+
+# Separators between tags in release names (dots, dashes, underscores, spaces...)
+_RELEASE_SEPARATOR_RE = re.compile(r'[\W_]+')
+
+# Whitespace-only lines, which separate cues just like empty ones
+_BLANK_LINE_RE = re.compile(r'\n[ \t]+(?=\n)')
+
+def _normalize_newlines(text: str) -> str:
+    """Unix line endings, with whitespace-only lines emptied so cues always split on '\n\n'"""
+    return _BLANK_LINE_RE.sub('\n', text.replace('\r\n', '\n'))
+
+def content_etag(content: bytes) -> str:
+    """Strong ETag for a serialized response body"""
+    return f'"{hashlib.sha1(content).hexdigest()}"'
+
+def _release_tokens(name: str) -> FrozenSet[str]:
+    """Split a release or file name into its lowercase tags"""
+    return frozenset(_RELEASE_SEPARATOR_RE.sub(' ', name.lower()).split())
+
+class RateLimitedError(Exception):
+    """OpenSubtitles asked for a back-off longer than a request should wait"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"OpenSubtitles rate limit, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
 
 class SubtitleEntry:
+    __slots__ = ("start", "text", "translated_text")
+
     def __init__(self, start: int, text: str):
         self.start = start  # Start time in milliseconds
         self.text = text
         self.translated_text: Optional[str] = None
 
-    def to_dict(self) -> Dict:
-        return {
-            "start": self.start,
-            "text": self.translated_text or self.text
-        }
-
 class SubtitleProcessor:
     # Class-level storage
     _user_rate_limits = {}
+    _mem_cache: "OrderedDict[str, Tuple[float, bytes, str]]" = OrderedDict()
+    _fetch_cache: "OrderedDict[Tuple, Tuple[float, List[SubtitleEntry]]]" = OrderedDict()
     _cache_lock = asyncio.Lock()
     _rate_limit_cleanup_lock = asyncio.Lock()
-    _last_cleanup = datetime.now()
+    _last_cleanup = time.monotonic()
+    _last_cache_prune = 0.0
+    _session: Optional[aiohttp.ClientSession] = None
+    
+    # Settings shared by every instance
+    base_url = "https://api.opensubtitles.com/api/v1"
+    batch_size = 15  # Free tier: 15 requests per second
+    window_size = 60  # 1 minute window
+    buffer_time = 2 * 60 * 1000  # 2 minutes buffer in milliseconds
+    cache_ttl = 7 * 24 * 60 * 60  # 7 days in seconds
+    download_cache_dir = CACHE_DIR  # Parsed OpenSubtitles downloads, shares the response cache TTL
+    mem_cache_size = 256  # In-memory cache entries
+    fetch_cache_ttl = 60 * 60  # Reuse parsed OpenSubtitles results for an hour
+    fetch_cache_size = 32  # Parsed OpenSubtitles results kept in memory
+    cleanup_interval = 60 * 60  # Cleanup every hour
+    max_rate_limit_wait = 10  # Longest server back-off waited out inside a request, in seconds
+    match_candidates = 10  # Subtitles compared against the video filename
+    good_match_ratio = 0.95  # Stop comparing once a match is this close
     
     def __init__(self, api_key: str, app_name: str = "Stremio AI Translator"):
         self.api_key = api_key
         self.app_name = app_name
-        self.base_url = "https://api.opensubtitles.com/api/v1"
-        self.batch_size = 15  # Free tier: 15 requests per second
-        self.window_size = 60  # 1 minute window
-        self.buffer_time = 2 * 60 * 1000  # 2 minutes buffer in milliseconds
-        self.cache_ttl = 7 * 24 * 60 * 60  # 7 days in seconds
-        self.cleanup_interval = 60 * 60  # Cleanup every hour
+
+    @classmethod
+    async def _get_session(cls) -> aiohttp.ClientSession:
+        """Shared pooled HTTP session, created on first use"""
+        if cls._session is None or cls._session.closed:
+            cls._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=64, ttl_dns_cache=300, keepalive_timeout=60, enable_cleanup_closed=True
+                ),
+                timeout=aiohttp.ClientTimeout(total=30)
+            )
+        return cls._session
+
+    @classmethod
+    async def close_session(cls):
+        """Close the shared HTTP session on shutdown"""
+        if cls._session is not None and not cls._session.closed:
+            await cls._session.close()
+        cls._session = None
+
+    async def _acquire_rate_limit(self):
+        """Token bucket per API key, refilled at batch_size requests per second"""
+        while True:
+            now = time.monotonic()
+            bucket = self._user_rate_limits.setdefault(
+                self.api_key, {"tokens": float(self.batch_size), "updated": now, "resume_at": 0.0}
+            )
+            
+            # The server asked us to back off, fail fast if it is longer than a request can wait
+            wait = bucket["resume_at"] - now
+            if wait > self.max_rate_limit_wait:
+                raise RateLimitedError(wait)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            
+            # No await between reading and updating the bucket, so no lock is needed
+            bucket["tokens"] = min(self.batch_size, bucket["tokens"] + (now - bucket["updated"]) * self.batch_size)
+            bucket["updated"] = now
+            if bucket["tokens"] >= 1:
+                bucket["tokens"] -= 1
+                break
+            await asyncio.sleep((1 - bucket["tokens"]) / self.batch_size)
+        
+        self._cleanup_rate_limits(now)
+
+    def _apply_rate_limit_headers(self, response: aiohttp.ClientResponse) -> float:
+        """Pause this key's bucket when OpenSubtitles reports the quota is used up, returns the pause"""
+        if response.status == 429:
+            try:
+                wait = float(response.headers.get('Retry-After', 1))
+            except ValueError:
+                wait = 1.0
+        elif response.headers.get('X-RateLimit-Remaining') == '0':
+            wait = 1.0  # Quota is per second
+        else:
+            return 0.0
+        
+        bucket = self._user_rate_limits.get(self.api_key)
+        if bucket is not None:
+            logger.debug("OpenSubtitles rate limit reached, pausing %.1fs", wait)
+            bucket["tokens"] = 0.0
+            bucket["resume_at"] = max(bucket["resume_at"], time.monotonic() + wait)
+        return wait
+
+    async def _api_request(self, session: aiohttp.ClientSession, method: str, url: str, error_label: str, **kwargs) -> Dict:
+        """Rate-limited OpenSubtitles API call, waiting out a single 429 before giving up"""
+        for attempt in range(2):
+            await self._acquire_rate_limit()
+            async with session.request(method, url, **kwargs) as response:
+                wait = self._apply_rate_limit_headers(response)
+                if response.status == 429:
+                    if attempt == 0 and wait <= self.max_rate_limit_wait:
+                        continue
+                    raise RateLimitedError(wait)
+                if response.status != 200:
+                    error_text = await response.text()
+                    logger.error("OpenSubtitles %s: %s", error_label, error_text)
+                    raise Exception(f"{error_label}: {response.status} - {error_text}")
+                return await response.json()
+
+    def _cleanup_rate_limits(self, now: float):
+        """Drop buckets of users idle for longer than the rate-limit window"""
+        if now - SubtitleProcessor._last_cleanup < self.cleanup_interval:
+            return
+        SubtitleProcessor._last_cleanup = now
+        # Buckets still serving a server back-off are kept until it has passed
+        for key in [
+            k for k, b in self._user_rate_limits.items()
+            if now - b["updated"] > self.window_size and b["resume_at"] <= now
+        ]:
+            del self._user_rate_limits[key]
 
     def parse_srt(self, srt_content: str) -> List[SubtitleEntry]:
         """Parse SRT content into subtitle entries"""
+        content = _normalize_newlines(srt_content)
         entries = []
-        current_entry = None
-        current_text = []
-        
-        for line in srt_content.strip().split('\n'):
-            line = line.strip()
+        pos = 0
+        while True:
+            # Each cue is anchored on its timecode arrow
+            arrow = content.find('-->', pos)
+            if arrow == -1:
+                break
+            line_start = content.rfind('\n', pos, arrow) + 1
+            text_start = content.find('\n', arrow) + 1
+            if text_start == 0:
+                break
+            # Text runs to the next blank line (search from the newline ending the timecode)
+            text_end = content.find('\n\n', text_start - 1)
+            if text_end == -1:
+                text_end = len(content)
+            pos = max(text_end, text_start)
             
-            if not line:  # Empty line indicates end of entry
-                if current_entry is not None and current_text:
-                    current_entry.text = ' '.join(current_text)
-                    entries.append(current_entry)
-                    current_entry = None
-                    current_text = []
+            try:
+                h, m, rest = content[line_start:arrow].strip().split(':')
+                s, _, ms = rest.replace('.', ',').partition(',')
+                start_ms = (int(h) * 3600 + int(m) * 60 + int(s)) * 1000 + int(ms.ljust(3, '0')[:3])
+            except ValueError:
                 continue
-                
-            if current_entry is None:
-                try:
-                    int(line)  # Entry number, skip
-                    current_entry = SubtitleEntry(0, "")
-                except ValueError:
-                    if '-->' in line:  # Time line
-                        start = line.split('-->')[0].strip()
-                        h, m, s = start.split(':')
-                        s, ms = s.split(',')
-                        start_ms = (int(h) * 3600 + int(m) * 60 + int(s)) * 1000 + int(ms)
-                        current_entry = SubtitleEntry(start_ms, "")
-            else:
-                current_text.append(line)
-                
-        # Handle last entry
-        if current_entry is not None and current_text:
-            current_entry.text = ' '.join(current_text)
-            entries.append(current_entry)
             
+            text = ' '.join(line.strip() for line in content[text_start:text_end].split('\n') if line.strip())
+            if text:
+                entries.append(SubtitleEntry(start_ms, text))
         return entries
 
-    async def load_cache(self, cache_path: Path) -> Optional[Dict]:
-        """Load translated subtitles from cache if not expired"""
+    async def iter_parse_srt(self, response: aiohttp.ClientResponse) -> AsyncIterator[SubtitleEntry]:
+        """Parse SRT from an HTTP response as chunks arrive, yielding complete cues"""
+        decoder = codecs.getincrementaldecoder(response.charset or 'utf-8')(errors='replace')
+        buffer = ''
+        async for chunk in response.content.iter_chunked(65536):
+            buffer = _normalize_newlines(buffer + decoder.decode(chunk))
+            # Only parse up to the last blank line, the tail may be a partial cue
+            cut = buffer.rfind('\n\n')
+            if cut == -1:
+                continue
+            for entry in self.parse_srt(buffer[:cut]):
+                yield entry
+            buffer = buffer[cut + 2:]
+        
+        buffer += decoder.decode(b'', final=True)
+        for entry in self.parse_srt(buffer):
+            yield entry
+
+    def _read_cache_file(self, cache_path: Path) -> Optional[Tuple[float, bytes, str]]:
+        """Blocking cache read, returns expiry timestamp, content and its ETag"""
+        try:
+            mtime = cache_path.stat().st_mtime
+        except FileNotFoundError:
+            return None
+        
+        expires_at = mtime + self.cache_ttl
+        if time.time() > expires_at:
+            cache_path.unlink(missing_ok=True)
+            return None
+        
+        content = cache_path.read_bytes()
+        return expires_at, content, content_etag(content)
+
+    def _write_cache_file(self, cache_path: Path, content: bytes):
+        """Blocking cache write, replaced atomically so readers never see a partial file"""
+        # Unique temp file per write, concurrent writers of the same key never share one
+        fd, temp_name = tempfile.mkstemp(dir=cache_path.parent, prefix=f"{cache_path.name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            # mkstemp creates 0600 files, keep cache files readable like a plain write would
+            os.chmod(temp_name, 0o644)
+            os.replace(temp_name, cache_path)
+        except BaseException:
+            Path(temp_name).unlink(missing_ok=True)
+            raise
+
+    def _prune_cache_dir(self, cache_dir: Path) -> int:
+        """Blocking removal of cache files older than the cache TTL, judged by mtime"""
+        cutoff = time.time() - self.cache_ttl
+        removed = 0
+        with os.scandir(cache_dir) as it:
+            for entry in it:
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < cutoff:
+                        os.unlink(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    continue
+        return removed
+
+    async def _maybe_prune_cache(self, cache_dir: Path):
+        """Prune the cache directory off the event loop, at most once per cleanup interval"""
+        now = time.monotonic()
+        if SubtitleProcessor._last_cache_prune and now - SubtitleProcessor._last_cache_prune < self.cleanup_interval:
+            return
+        SubtitleProcessor._last_cache_prune = now
+        try:
+            removed = await asyncio.to_thread(self._prune_cache_dir, cache_dir)
+        except Exception as e:
+            logger.warning("Cache prune error: %s", e)
+            return
+        if removed:
+            logger.info("Removed %d expired cache files", removed)
+
+    def _remember(self, key: str, expires_at: float, content: bytes, etag: str):
+        """Store content and its ETag in the in-memory cache, evicting the oldest entry"""
+        self._mem_cache[key] = (expires_at, content, etag)
+        self._mem_cache.move_to_end(key)
+        if len(self._mem_cache) > self.mem_cache_size:
+            self._mem_cache.popitem(last=False)
+
+    async def load_cache(self, cache_path: Path) -> Optional[Tuple[bytes, str]]:
+        """Load serialized subtitle response and its ETag from memory or disk cache if not expired"""
+        key = str(cache_path)
+        hit = self._mem_cache.get(key)
+        if hit:
+            if time.time() <= hit[0]:
+                self._mem_cache.move_to_end(key)
+                return hit[1], hit[2]
+            self._mem_cache.pop(key, None)
+        
         async with self._cache_lock:
-            if not cache_path.exists():
-                return None
-                
             try:
-                with open(cache_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                
-                timestamp = data.get("timestamp", 0)
-                now = datetime.now().timestamp()
-                
-                if now - timestamp > self.cache_ttl:
-                    cache_path.unlink()
-                    return None
-                
-                return {"subtitles": data["subtitles"]}
-            except json.JSONDecodeError as e:
-                print(f"Cache JSON decode error: {str(e)}")
-                if cache_path.exists():
-                    try:
-                        cache_path.unlink()
-                    except:
-                        pass
-                return None
+                cached = await asyncio.to_thread(self._read_cache_file, cache_path)
             except Exception as e:
-                print(f"Cache error: {str(e)}")
+                logger.warning("Cache error: %s", e)
                 return None
-                
-                timestamp = data.get("timestamp", 0)
-                now = datetime.now().timestamp()
-                
-                if now - timestamp > self.cache_ttl:
-                    cache_path.unlink()
-                    return None
-                
-                return {"subtitles": data["subtitles"]}
-            except json.JSONDecodeError as e:
-                print(f"Cache JSON decode error: {str(e)}")
-                if cache_path.exists():
-                    try:
-                        cache_path.unlink()
-                    except:
-                        pass
+            if not cached:
                 return None
+            self._remember(key, *cached)
+            return cached[1], cached[2]
+
+    async def save_cache(self, cache_path: Path, payload: Dict) -> Tuple[bytes, str]:
+        """Serialize subtitle response and its ETag once and store them in cache"""
+        content = orjson.dumps(payload)
+        etag = content_etag(content)
+        async with self._cache_lock:
+            try:
+                await asyncio.to_thread(self._write_cache_file, cache_path, content)
             except Exception as e:
-                print(f"Cache error: {str(e)}")
+                logger.warning("Cache write error: %s", e)
+            self._remember(str(cache_path), time.time() + self.cache_ttl, content, etag)
+        await self._maybe_prune_cache(cache_path.parent)
+        return content, etag
+
+    def _remember_fetch(self, fetch_key: Tuple, entries: List[SubtitleEntry]):
+        """Store parsed subtitles in the in-memory fetch cache, evicting the oldest entry"""
+        self._fetch_cache[fetch_key] = (time.monotonic(), entries)
+        self._fetch_cache.move_to_end(fetch_key)
+        if len(self._fetch_cache) > self.fetch_cache_size:
+            self._fetch_cache.popitem(last=False)
+
+    def _download_cache_path(self, fetch_key: Tuple) -> Path:
+        """Disk location of a parsed download, keyed by IMDB id, episode and filename"""
+        digest = hashlib.sha1(repr(fetch_key).encode()).hexdigest()
+        return self.download_cache_dir / f"download-{digest}.json"
+
+    async def _load_download(self, fetch_key: Tuple) -> Optional[List[SubtitleEntry]]:
+        """Load a previously downloaded subtitle from disk if not expired"""
+        try:
+            cached = await asyncio.to_thread(self._read_cache_file, self._download_cache_path(fetch_key))
+            if not cached:
                 return None
+            return [SubtitleEntry(start, text) for start, text in orjson.loads(cached[1])]
+        except Exception as e:
+            logger.warning("Download cache error: %s", e)
+            return None
+
+    async def _save_download(self, fetch_key: Tuple, entries: List[SubtitleEntry]):
+        """Keep a parsed download on disk so replays skip OpenSubtitles entirely"""
+        content = orjson.dumps([(entry.start, entry.text) for entry in entries])
+        # No _cache_lock: concurrent misses for the same key write identical content,
+        # each through its own temp file, and the atomic replace means the last one wins whole
+        try:
+            await asyncio.to_thread(self._write_cache_file, self._download_cache_path(fetch_key), content)
+        except Exception as e:
+            logger.warning("Download cache write error: %s", e)
 
     async def fetch_subtitles(self, type: str, id: str) -> List[SubtitleEntry]:
         """Fetch subtitles from OpenSubtitles"""
         try:
+            # Extract video filename from parameters if available
+            id, _, query = id.partition('&')
+            video_filename = dict(parse_qsl(query)).get('filename') if query else None
+
             # Parse IMDB ID and episode info if series
             imdb_id = id
             season = None
             episode = None
-            if type == 'series' and ':' in id:
-                parts = id.split(':')
-                imdb_id = parts[0]
-                if len(parts) > 2:
-                    season = parts[1]
-                    episode = parts[2]
+            if type == 'series':
+                imdb_id, _, rest = id.partition(':')
+                season, _, episode = rest.partition(':')
+                season, episode = (season, episode.partition(':')[0]) if episode else (None, None)
+            numeric_imdb_id = imdb_id[2:] if imdb_id.startswith('tt') else imdb_id
+
+            fetch_key = (type, imdb_id, season, episode, video_filename)
+            hit = self._fetch_cache.get(fetch_key)
+            if hit and time.monotonic() - hit[0] < self.fetch_cache_ttl:
+                self._fetch_cache.move_to_end(fetch_key)
+                return list(hit[1])
+            
+            entries = await self._load_download(fetch_key)
+            if entries is not None:
+                logger.debug("Using cached download for %s", fetch_key)
+                self._remember_fetch(fetch_key, entries)
+                return list(entries)
 
             # Build search query with optimized parameters
             search_params = {
@@ -150,14 +397,14 @@ class SubtitleProcessor:
 
             # Add content identifiers
             if type == 'series':
-                search_params['parent_imdb_id'] = imdb_id.replace('tt', '')
+                search_params['parent_imdb_id'] = numeric_imdb_id
                 if season and episode:
                     search_params['season_number'] = int(season)
                     search_params['episode_number'] = int(episode)
             else:
-                search_params['imdb_id'] = imdb_id.replace('tt', '')
+                search_params['imdb_id'] = numeric_imdb_id
 
-            print(f"OpenSubtitles search params: {json.dumps(search_params, indent=2)}")
+            logger.debug("OpenSubtitles search params: %s", search_params)
             
             # Set up headers for API requests
             headers = {
@@ -166,96 +413,92 @@ class SubtitleProcessor:
                 'User-Agent': f"{self.app_name}"
             }
 
-            async with aiohttp.ClientSession() as session:
-                # Search for subtitles
-                async with session.get(
-                    f"{self.base_url}/subtitles",
-                    params=search_params,
-                    headers=headers
-                ) as response:
-                    if response.status != 200:
-                        error_text = await response.text()
-                        print(f"OpenSubtitles API error: {error_text}")
-                        raise Exception(f"API error: {response.status} - {error_text}")
-                    
-                    data = await response.json()
-                    print(f"OpenSubtitles search results: {json.dumps(data, indent=2)}")
-                    
-                    if not data.get('data'):
-                        raise Exception("No subtitles found")
-
-                # Extract video filename from parameters if available
-                video_filename = None
-                if '&videoSize=' in id:
-                    try:
-                        params = dict(p.split('=') for p in id.split('&'))
-                        if 'filename' in params:
-                            video_filename = params['filename']
-                    except:
-                        pass
-
-                # Filter out foreign parts only subtitles unless that's all we have
-                normal_subs = [s for s in data['data'] if not s.get('attributes', {}).get('foreign_parts_only', False)]
-                subtitles = normal_subs if normal_subs else data['data']
-
-                # Find best matching subtitle
-                best_subtitle = None
-                best_match_ratio = 0
-
-                print("Comparing subtitles for video:", video_filename or "Using embedded English subtitles")
+            session = await self._get_session()
+            # Search for subtitles
+            data = await self._api_request(
+                session, 'GET', f"{self.base_url}/subtitles", "API error",
+                params=search_params,
+                headers=headers
+            )
+            logger.debug("OpenSubtitles search results: %s", data)
+            
+            if not data.get('data'):
+                raise Exception("No subtitles found")
+
+            # Filter out foreign parts only subtitles unless that's all we have
+            normal_subs = [s for s in data['data'] if not s.get('attributes', {}).get('foreign_parts_only', False)]
+            subtitles = normal_subs if normal_subs else data['data']
+
+            # Rank once by download count, pulling out the fields used for matching
+            ranked = []
+            for subtitle in subtitles:
+                attributes = subtitle.get('attributes', {})
+                name = attributes.get('release', '') or attributes.get('files', [{}])[0].get('file_name', '')
+                ranked.append((attributes.get('download_count', 0), name, subtitle))
+            ranked.sort(key=itemgetter(0), reverse=True)
+
+            # Find best matching subtitle
+            best = None
+            best_match_ratio = 0
+
+            logger.debug("Comparing subtitles for video: %s", video_filename or "Using embedded English subtitles")
+            
+            if video_filename:
+                video_tokens = _release_tokens(video_filename)
                 
-                for subtitle in subtitles:
-                    sub_filename = subtitle.get('attributes', {}).get('release', '') or subtitle.get('attributes', {}).get('files', [{}])[0].get('file_name', '')
-                    
-                    if video_filename and sub_filename:
-                        clean_video = re.sub(r'[^\w\s]', '', video_filename.lower())
-                        clean_sub = re.sub(r'[^\w\s]', '', sub_filename.lower())
-                        
-                        ratio = SequenceMatcher(None, clean_video, clean_sub).ratio()
-                        print(f"Subtitle: {sub_filename}")
-                        print(f"Similarity: {ratio * 100:.2f}%")
-                        print(f"Foreign parts only: {subtitle.get('attributes', {}).get('foreign_parts_only', False)}")
-                        
-                        if ratio > best_match_ratio:
-                            best_match_ratio = ratio
-                            best_subtitle = subtitle
-
-                if not best_subtitle:
-                    best_subtitle = max(subtitles, key=lambda s: s.get('attributes', {}).get('download_count', 0))
-                    print(f"No filename match found, using most downloaded subtitle")
-
-                file_id = best_subtitle.get('attributes', {}).get('files', [{}])[0].get('file_id')
-                if not file_id:
-                    raise Exception("Could not get file ID from subtitle")
-
-                print(f"Selected subtitle: {best_subtitle.get('attributes', {}).get('release', '')}")
-                print(f"Download count: {best_subtitle.get('attributes', {}).get('download_count', 0)}")
-                print(f"Match ratio: {best_match_ratio * 100:.2f}%")
-                print(f"File ID: {file_id}")
-
-                # Download subtitle
-                async with session.post(
-                    f"{self.base_url}/download",
-                    headers=headers,
-                    json={
-                        'file_id': file_id,
-                        'sub_format': 'srt'  # Request SRT format
-                    }
-                ) as download_response:
-                    if download_response.status != 200:
-                        error_text = await download_response.text()
-                        raise Exception(f"Download error: {download_response.status} - {error_text}")
+                # Only the most downloaded candidates are worth comparing
+                for candidate in ranked[:self.match_candidates]:
+                    sub_filename = candidate[1]
+                    if not sub_filename:
+                        continue
                     
-                    download_data = await download_response.json()
-                    print(f"Download response: {json.dumps(download_data, indent=2)}")
+                    # Jaccard similarity of release tags (Show, S01E02, 1080p, WEB-DL, group...)
+                    sub_tokens = _release_tokens(sub_filename)
+                    ratio = len(video_tokens & sub_tokens) / max(1, len(video_tokens | sub_tokens))
+                    logger.debug("Subtitle: %s", sub_filename)
+                    logger.debug("Similarity: %.2f%%", ratio * 100)
                     
-                    async with session.get(download_data['link']) as content_response:
-                        if content_response.status != 200:
-                            raise Exception(f"Content download failed: {content_response.status}")
-                        
-                        srt_content = await content_response.text()
-                        return self.parse_srt(srt_content)
+                    if ratio > best_match_ratio:
+                        best_match_ratio = ratio
+                        best = candidate
+                        if ratio >= self.good_match_ratio:
+                            break
+
+            if not best:
+                best = ranked[0]
+                logger.debug("No filename match found, using most downloaded subtitle")
+            download_count, best_name, best_subtitle = best
+
+            file_id = best_subtitle.get('attributes', {}).get('files', [{}])[0].get('file_id')
+            if not file_id:
+                raise Exception("Could not get file ID from subtitle")
+
+            logger.debug("Selected subtitle: %s", best_name)
+            logger.debug("Download count: %s", download_count)
+            logger.debug("Match ratio: %.2f%%", best_match_ratio * 100)
+            logger.debug("File ID: %s", file_id)
+
+            # Download subtitle
+            download_data = await self._api_request(
+                session, 'POST', f"{self.base_url}/download", "Download error",
+                headers=headers,
+                json={
+                    'file_id': file_id,
+                    'sub_format': 'srt'  # Request SRT format
+                }
+            )
+            logger.debug("Download response: %s", download_data)
+            
+            async with session.get(download_data['link']) as content_response:
+                if content_response.status != 200:
+                    raise Exception(f"Content download failed: {content_response.status}")
+                
+                entries = [entry async for entry in self.iter_parse_srt(content_response)]
+
+            await self._save_download(fetch_key, entries)
+            self._remember_fetch(fetch_key, entries)
+            return list(entries)
 
         except Exception as e:
-            print(f"Error fetching subtitles: {str(e)}")
+            logger.error("Error fetching subtitles: %s", e)
             raise
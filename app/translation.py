@@ -1,7 +1,10 @@
 import google.generativeai as genai
 import json
+import logging
 from typing import Optional
 
+logger = logging.getLogger(__name__)
+
 class TranslationManager:
     def __init__(self, api_key: str, target_lang: str):
         self.target_lang = target_lang
@@ -24,8 +27,8 @@ class TranslationManager:
             # Validate and parse input SRT format
             lines = text.strip().split('\n')
             if len(lines) < 3 or not lines[0].isdigit() or ' --> ' not in lines[1]:
-                print("Invalid SRT format")
-                print(f"Received lines: {lines}")
+                logger.warning("Invalid SRT format")
+                logger.debug("Received lines: %s", lines)
                 return None
 
             try:
@@ -35,9 +38,9 @@ class TranslationManager:
                 end_time = timecodes[1]
                 subtitle_text = '\n'.join(lines[2:]).strip()
             except ValueError as e:
-                print(f"Error parsing SRT index or timecodes: {str(e)}")
+                logger.warning("Error parsing SRT index or timecodes: %s", e)
                 return None
             # Additional parsing logic follows...
         except Exception as e:
-            print(f"Error during SRT validation or parsing: {str(e)}")
+            logger.error("Error during SRT validation or parsing: %s", e)
             return None